@@ -1,13 +1,43 @@
 import asyncio
-from playwright.async_api import async_playwright
+import json
+import time
+import aiohttp
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict
-from os import path, makedirs
+from os import path, makedirs, replace, cpu_count
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%dT%H:%M:%S.%fZ', encoding='utf-8')
 
+# JSON backend behind the DynamicCollectors page (captured from the XHR the
+# is-db page issues on load). Hitting it directly skips the browser entirely.
+API_URL = 'https://www.gov.il/he/api/DataGovProxy/GetDGResults'
+DYNAMIC_TEMPLATE_ID = '4dab2335-30f6-4b0e-93bd-88bc0be4e6ab'
+PAGE_SIZE = 20
+MAX_CONCURRENCY = 32
+
+# AIMD rate control: add AIMD_INCREASE to the concurrency target on every
+# success, multiply by AIMD_DECREASE on 429/5xx, bounded to [MIN_, MAX_CONCURRENCY].
+MIN_CONCURRENCY = 1
+AIMD_INCREASE = 0.5
+AIMD_DECREASE = 0.5
+MAX_RPM = 120
+MAX_RETRIES = 5
+
+# Per-page on-disk cache so reruns only fetch pages that are missing or stale
+CACHE_DIR = 'output/.cache'
+CACHE_TTL = 24 * 3600
+
+# Below this row count the per-process overhead of a parallel transform
+# outweighs the gain, so transform_data_parallel falls back to one pass
+PARALLEL_TRANSFORM_THRESHOLD = 100_000
+
 # Map Hebrew fields to English keys
 field_mapping = {
     'שם מלא': 'full_name',
@@ -29,101 +59,167 @@ field_mapping = {
 class DynamicPrisonerScraper:
     def __init__(self, base_url: str):
         self.base_url = base_url
+        self.total = 0
+        # AIMD state: start conservatively and let successes ramp it up
+        self.concurrency = 8.0
+        self.active = 0
+        self.request_times = deque()
+
+    async def init_session(self):
+        """Initialize the HTTP session."""
+        # One pooled session for the whole run: keep-alive connections
+        # amortize the TCP+TLS handshake across all page fetches, and the
+        # DNS cache avoids re-resolving gov.il per request. aiohttp
+        # advertises and decodes compression on its own, so no custom
+        # Accept-Encoding header
+        connector = aiohttp.TCPConnector(
+            limit=128,
+            limit_per_host=64,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        )
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close_session(self):
+        """Close the HTTP session."""
+        await self.session.close()
+
+    async def throttle(self):
+        """Wait until the RPM budget and the AIMD concurrency target allow another request."""
+        while True:
+            now = time.monotonic()
+            while self.request_times and now - self.request_times[0] > 60:
+                self.request_times.popleft()
+            if len(self.request_times) < MAX_RPM and self.active < int(self.concurrency):
+                self.request_times.append(now)
+                self.active += 1
+                return
+            await asyncio.sleep(0.1)
 
-    async def init_browser(self):
-        """Initialize the browser instance."""
-        self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(headless=True)
-        self.context = await self.browser.new_context()
-        self.page = await self.context.new_page()
+    async def fetch_with_backoff(self, payload: Dict) -> Dict:
+        """POST to the API, honouring rate-limit headers with AIMD backpressure."""
+        for attempt in range(MAX_RETRIES):
+            await self.throttle()
+            try:
+                async with self.session.post(API_URL, json=payload) as response:
+                    if response.status == 429 or response.status >= 500:
+                        # Multiplicative decrease, then honour Retry-After;
+                        # the header may also be an HTTP-date (RFC 9110),
+                        # in which case fall back to exponential delay
+                        self.concurrency = max(MIN_CONCURRENCY, self.concurrency * AIMD_DECREASE)
+                        try:
+                            retry_after = float(response.headers.get('Retry-After', 2 ** attempt))
+                        except ValueError:
+                            retry_after = float(2 ** attempt)
+                        logging.warning(f"Got {response.status}, retrying in {retry_after}s "
+                                        f"(concurrency={self.concurrency:.1f})")
+                        await asyncio.sleep(retry_after)
+                        continue
+                    response.raise_for_status()
+                    body = await response.json()
+                    remaining = response.headers.get('X-RateLimit-Remaining')
+            finally:
+                self.active -= 1
 
-    async def close_browser(self):
-        """Close all browser instances."""
-        await self.context.close()
-        await self.browser.close()
-        await self.playwright.stop()
+            # Additive increase on success, unless the server says we're nearly out
+            if remaining is not None and int(remaining) <= 1:
+                self.concurrency = max(MIN_CONCURRENCY, self.concurrency * AIMD_DECREASE)
+            else:
+                self.concurrency = min(MAX_CONCURRENCY, self.concurrency + AIMD_INCREASE)
+            return body
+
+        raise RuntimeError(f"Giving up after {MAX_RETRIES} attempts for payload {payload}")
+
+    def load_cached_page(self, skip: int) -> List[Dict]:
+        """Return the cached page for this skip if present and fresh, else None."""
+        cache_file = path.join(CACHE_DIR, f'page_{skip}.json')
+        if path.exists(cache_file) and time.time() - path.getmtime(cache_file) < CACHE_TTL:
+            with open(cache_file, encoding='utf-8') as f:
+                cached = json.load(f)
+            self.total = cached.get('total', self.total)
+            return cached.get('results', [])
+        return None
+
+    def store_cached_page(self, skip: int, prisoners: List[Dict]):
+        """Atomically write a page (and the reported total) to the on-disk cache."""
+        if not path.exists(CACHE_DIR):
+            makedirs(CACHE_DIR)
+        cache_file = path.join(CACHE_DIR, f'page_{skip}.json')
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'total': self.total, 'results': prisoners}, f, ensure_ascii=False)
+        replace(tmp_file, cache_file)
 
     async def get_page_data(self, skip: int) -> List[Dict]:
-        """Fetch and extract data from a single page."""
-        url = f"{self.base_url}?skip={skip}"
-        
+        """Fetch and extract data from a single page of the JSON backend."""
+        cached = self.load_cached_page(skip)
+        if cached is not None:
+            logging.info(f"Loaded {len(cached)} records with skip={skip} from cache")
+            return cached
+
+        payload = {'DynamicTemplateID': DYNAMIC_TEMPLATE_ID, 'skip': skip, 'take': PAGE_SIZE}
+
         try:
-            # Navigate to the page
-            await self.page.goto(url, wait_until="networkidle")
-            logging.info(f"Page loaded: {url}")
-            
-            # Wait for the content to load
-            await self.page.wait_for_selector('.row.row-gov.ordered-fields', timeout=30000)
-            
-            # Extract all prisoner rows
-            rows = await self.page.query_selector_all('.row.row-gov.ordered-fields')
-            logging.info(f"Found {len(rows)} rows on the page")
-            
-            prisoners_data = []
-            for row in rows:
-                data = {}
-                
-                # Get all field divs in the row
-                fields = await row.query_selector_all('.col-12')
-                
-                for field in fields:
-                    # Get label and value
-                    label_elem = await field.query_selector('label')
-                    value_elem = await field.query_selector('.error-txt')
-                    if label_elem and value_elem:
-                        label = await label_elem.inner_text()
-                        value = await value_elem.inner_text()
-                        english_key = field_mapping.get(label.strip())
-                        if english_key:
-                            data[english_key] = value.strip()
+            body = await self.fetch_with_backoff(payload)
 
+            records = body.get('Results', [])
+            self.total = body.get('TotalResults', self.total)
+            logging.info(f"Fetched {len(records)} records with skip={skip}")
+
+            prisoners_data = []
+            for record in records:
+                data = {field_mapping[k]: v.strip() if isinstance(v, str) else v
+                        for k, v in record.items() if k in field_mapping}
                 prisoners_data.append(data)
                 logging.info(f"Extracted data for prisoner: {data.get('full_name')}")
-            
+
+            self.store_cached_page(skip, prisoners_data)
             return prisoners_data
-            
+
         except Exception as e:
             logging.error(f"Error processing page with skip={skip}: {e}")
             return []
     
-    async def scrape_all_pages(self, max_pages: int = None) -> List[Dict]:
-        """Scrape all pages of the prisoner database."""
-        await self.init_browser()
-        
-        all_prisoners = []
-        skip = 0
-        page_num = 1
-        
+    async def scrape_all_pages(self, output_file: str, max_pages: int = None) -> int:
+        """Scrape all pages of the prisoner database, streaming each page to Parquet."""
+        await self.init_session()
+
+        # Pages are written as they arrive, so peak memory is one page
+        # rather than the whole dataset
+        schema = pa.schema([(name, pa.string()) for name in field_mapping.values()])
+        writer = pq.ParquetWriter(output_file, schema, compression='zstd')
+        written = 0
+
+        def write_page(prisoners: List[Dict]):
+            nonlocal written
+            if prisoners:
+                writer.write_table(pa.Table.from_pylist(prisoners, schema=schema))
+                written += len(prisoners)
+
         try:
-            while True:
-                logging.info(f"Scraping page {page_num}")
-                
-                prisoners = await self.get_page_data(skip)
-                if not prisoners:
-                    break
-                
-                all_prisoners.extend(prisoners)
-                logging.info(f"Found {len(prisoners)} prisoners on page {page_num}")
-                
-                if max_pages and page_num >= max_pages:
-                    break
-                
-                skip += 20  # Assuming 10 results per page
-                page_num += 1
-                
-                # Be nice to the server
-                await asyncio.sleep(2)
-                
+            # The first request discovers the total count; the remaining
+            # pages are then fetched concurrently under a bounded semaphore.
+            write_page(await self.get_page_data(0))
+            logging.info(f"Database reports {self.total} records")
+
+            skips = range(PAGE_SIZE, self.total, PAGE_SIZE)
+            if max_pages:
+                skips = skips[:max_pages - 1]
+
+            sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+            async def fetch_one(skip: int):
+                async with sem:
+                    write_page(await self.get_page_data(skip))
+
+            await asyncio.gather(*(fetch_one(s) for s in skips))
+
         finally:
-            await self.close_browser()
-        
-        return all_prisoners
+            writer.close()
+            await self.close_session()
 
-    def save_to_csv(self, data: List[Dict], filename: str):
-        """Save the scraped data to a CSV file."""
-        df = pd.DataFrame(data)
-        df.to_csv(filename, index=False, encoding='utf-8-sig')
-        logging.info(f"Data saved to {filename}")
+        logging.info(f"Data saved to {output_file}")
+        return written
 
 class PrisonerDataTransformer:
     def __init__(self):
@@ -175,79 +271,103 @@ class PrisonerDataTransformer:
             'קו ירוק': 'GREEN LINE',
         }
 
-    def safe_map(self, value: str, mapping: dict) -> str:
-        """Map a value using a dictionary, returning the original value if no mapping exists."""
-        if pd.isna(value):
-            return None
-        return mapping.get(value, value)
+        # Date columns arrive from the backend as DD/MM/YYYY
+        self.date_format = '%d/%m/%Y'
+
+        # Mapped columns with only a handful of distinct values; stored
+        # as category dtype after transformation
+        self.categorical_columns = [
+            'organization', 'status', 'court', 'gender', 'residence',
+            'israeli_citizenship', 'deportation_status'
+        ]
 
     def split_demographics(self, df: pd.DataFrame) -> pd.DataFrame:
         """Split the demographics column into gender, age, and residence columns."""
-        df_processed = df.copy()
-        
         # Split the demographics column into temporary series
-        split_data = df_processed['demographics'].str.split(',', expand=True)
-        
-        # Assign the split values to new columns, strip whitespace
-        df_processed['gender'] = split_data[0].str.strip()
-        df_processed['age'] = split_data[1].str.strip()
-        df_processed['residence'] = split_data[2].str.strip()
-        
-        # Apply mappings to gender and residence
-        df_processed['gender'] = df_processed['gender'].apply(lambda x: self.safe_map(x, self.gender_mapping))
-        df_processed['residence'] = df_processed['residence'].apply(lambda x: self.safe_map(x, self.residence_mapping))
-        
-        # Drop the original demographics column
-        df_processed.drop('demographics', axis=1, inplace=True)
-        
-        # Convert age to numeric, handling any errors
-        df_processed['age'] = pd.to_numeric(df_processed['age'], errors='coerce')
-        
-        return df_processed
+        split_data = df['demographics'].str.split(',', n=2, expand=True)
 
-    def format_date(self, date_str: str) -> str:
-        """Format date string to YYYY-MM-DD."""
-        try:
-            if pd.isna(date_str):
-                return None
-            # Parse the date string and format it
-            date_obj = pd.to_datetime(date_str)
-            return date_obj.strftime('%Y-%m-%d')
-        except Exception:
-            return None
+        gender = split_data[0].str.strip()
+        residence = split_data[2].str.strip()
+
+        # assign/drop reuse the existing column blocks, so only the three
+        # new columns allocate memory; gender and residence are mapped in
+        # one vectorized pass, keeping the original value wherever no
+        # mapping exists
+        # On Arrow-backed input, to_numeric coerces failures to NaN inside
+        # a double[pyarrow] array, where describe()/isnull() don't treat
+        # them as missing; float64 restores the skipna semantics
+        return df.assign(
+            gender=gender.map(self.gender_mapping).fillna(gender),
+            age=pd.to_numeric(split_data[1].str.strip(), errors='coerce').astype('float64'),
+            residence=residence.map(self.residence_mapping).fillna(residence),
+        ).drop(columns='demographics')
 
     def transform_data(self, df: pd.DataFrame) -> pd.DataFrame:
         """Apply all transformations to the dataframe."""
         # First split demographics
         df_transformed = self.split_demographics(df)
         
-        # Format dates
-        df_transformed['birth_date'] = df_transformed['birth_date'].apply(self.format_date)
-        df_transformed['arrest_date'] = df_transformed['arrest_date'].apply(self.format_date)
-        
-        # Apply mappings using safe_map
-        df_transformed['organization'] = df_transformed['organization'].apply(lambda x: self.safe_map(x, self.organization_mapping))
-        df_transformed['israeli_citizenship'] = df_transformed['israeli_citizenship'].apply(lambda x: self.safe_map(x, self.citizenship_mapping))
-        df_transformed['status'] = df_transformed['status'].apply(lambda x: self.safe_map(x, self.status_mapping))
-        df_transformed['court'] = df_transformed['court'].apply(lambda x: self.safe_map(x, self.court_mapping))
-        df_transformed['deportation_status'] = df_transformed['deportation_status'].apply(lambda x: self.safe_map(x, self.deportation_mapping))
+        # Format dates in one vectorized parse per column; the explicit
+        # format takes the tight C parsing path instead of per-value
+        # inference, and unparseable values still become NaT/None
+        df_transformed['birth_date'] = pd.to_datetime(df_transformed['birth_date'], format=self.date_format, errors='coerce').dt.strftime('%Y-%m-%d')
+        df_transformed['arrest_date'] = pd.to_datetime(df_transformed['arrest_date'], format=self.date_format, errors='coerce').dt.strftime('%Y-%m-%d')
         
+        # Apply all value mappings in a single C-level pass; unmapped
+        # values pass through unchanged
+        df_transformed = df_transformed.replace({
+            'organization': self.organization_mapping,
+            'israeli_citizenship': self.citizenship_mapping,
+            'status': self.status_mapping,
+            'court': self.court_mapping,
+            'deportation_status': self.deportation_mapping,
+        })
+
+        # Low-cardinality columns become categoricals (~10x less memory,
+        # faster value_counts/groupby) and age is downcast to the
+        # smallest integer type that fits
+        for col in self.categorical_columns:
+            df_transformed[col] = df_transformed[col].astype('category')
+        df_transformed['age'] = pd.to_numeric(df_transformed['age'], downcast='integer')
+
+        return df_transformed
+
+    def transform_data_parallel(self, df: pd.DataFrame, max_workers: int = None) -> pd.DataFrame:
+        """Transform a large dataframe in chunks, one worker process per core."""
+        if len(df) < PARALLEL_TRANSFORM_THRESHOLD:
+            return self.transform_data(df)
+
+        workers = max_workers or cpu_count()
+        chunk_size = -(-len(df) // workers)
+        chunks = [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(self.transform_data, chunks))
+        df_transformed = pd.concat(parts, ignore_index=True)
+
+        # Chunks can disagree on which category values they saw, which
+        # makes concat fall back to object; re-unify the dtypes here
+        for col in self.categorical_columns:
+            df_transformed[col] = df_transformed[col].astype('category')
+        df_transformed['age'] = pd.to_numeric(df_transformed['age'], downcast='integer')
+
         return df_transformed
 
     def validate_data(self, df: pd.DataFrame) -> dict:
         """Validate the transformed data and return statistics."""
+        # Count each categorical column with one bincount over its int8
+        # codes — O(categories), not a full value_counts scan per column
+        value_distributions = {}
+        for col in self.categorical_columns:
+            categories = df[col].cat.categories
+            codes = df[col].cat.codes.to_numpy()
+            counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+            value_distributions[col] = dict(zip(categories, counts.tolist()))
+
         stats = {
             'total_records': len(df),
             'null_values': df.isnull().sum().to_dict(),
-            'value_distributions': {
-                'gender': df['gender'].value_counts().to_dict(),
-                'residence': df['residence'].value_counts().to_dict(),
-                'organization': df['organization'].value_counts().to_dict(),
-                'israeli_citizenship': df['israeli_citizenship'].value_counts().to_dict(),
-                'status': df['status'].value_counts().to_dict(),
-                'court': df['court'].value_counts().to_dict(),
-                'deportation_status': df['deportation_status'].value_counts().to_dict()
-            },
+            'value_distributions': value_distributions,
             'age_stats': df['age'].describe().to_dict()
         }
         return stats
@@ -257,56 +377,69 @@ async def scrap_data():
     if not path.exists('output'):
         makedirs('output')
     
-    if path.exists('output/prisoners_data.csv'):
+    if path.exists('output/prisoners.parquet'):
         logging.info("File already exists, skipping scraping")
         return
     
     base_url = 'https://www.gov.il/he/Departments/DynamicCollectors/is-db'
     scraper = DynamicPrisonerScraper(base_url)
-    
+
     # Scrape the data (limit to 5 pages for testing)
     MAX_PAGES = None # 2
-    prisoners = await scraper.scrape_all_pages(max_pages=MAX_PAGES)
-    
-    # Save the results
-    scraper.save_to_csv(prisoners, 'output/prisoners_data.csv')
+    total = await scraper.scrape_all_pages('output/prisoners.parquet', max_pages=MAX_PAGES)
+    logging.info(f"Scraped {total} prisoners")
 
 def transform_data():
     try:
-        # Read the original CSV file
-        input_file = 'output/prisoners_data.csv'
-        df = pd.read_csv(input_file, encoding='utf-8-sig')
+        # Read the scraped Parquet file; Arrow-backed strings skip the
+        # per-value PyObject allocation for the Hebrew text columns
+        input_file = 'output/prisoners.parquet'
+        df = pd.read_parquet(input_file, dtype_backend='pyarrow')
         
         # Create transformer instance and transform data
         transformer = PrisonerDataTransformer()
-        df_transformed = transformer.transform_data(df)
+        df_transformed = transformer.transform_data_parallel(df)
         
         # Validate the transformed data
         validation_stats = transformer.validate_data(df_transformed)
         
-        # Save transformed data
-        output_file = 'output/prisoners_data_transformed.csv'
-        df_transformed.to_csv(output_file, index=False, encoding='utf-8-sig')
+        # Save transformed data as Parquet so the category/int8 dtypes
+        # survive; keep a CSV export for spreadsheet consumers
+        output_file = 'output/prisoners_data_transformed.parquet'
+        df_transformed.to_parquet(output_file, compression='zstd', engine='pyarrow')
+        df_transformed.to_csv('output/prisoners_data_transformed.csv', index=False, encoding='utf-8-sig')
         
-        # Output statistics and validation results to a markdown file
+        # Output statistics and validation results to a markdown file,
+        # built as one string and written in a single call
         stats_file = 'output/validation_stats.md'
+        lines = [
+            "# Data Transformation Statistics",
+            "",
+            "## Total Records",
+            f"Total records: {validation_stats['total_records']}",
+            "",
+            "## Value Distributions",
+        ]
+        for field, distribution in validation_stats['value_distributions'].items():
+            lines.append(f"### {field.replace('_', ' ').title()} Distribution")
+            lines.extend(f"- {value}: {count}" for value, count in distribution.items())
+        lines.append("")
+
+        age_stats = validation_stats['age_stats']
+        lines.extend([
+            "## Age Statistics",
+            f"- Average age: {age_stats['mean']:.1f}",
+            f"- Minimum age: {age_stats['min']}",
+            f"- Maximum age: {age_stats['max']}",
+            "",
+        ])
         with open(stats_file, 'w', encoding='utf-8') as f:
-            f.write(f"# Data Transformation Statistics\n\n")
-            f.write(f"## Total Records\n")
-            f.write(f"Total records: {validation_stats['total_records']}\n\n")
-            
-            f.write(f"## Value Distributions\n")
-            for field, distribution in validation_stats['value_distributions'].items():
-              f.write(f"### {field.replace('_', ' ').title()} Distribution\n")
-              for value, count in distribution.items():
-                f.write(f"- {value}: {count}\n")
-            f.write("\n")
-            
-            f.write(f"## Age Statistics\n")
-            age_stats = validation_stats['age_stats']
-            f.write(f"- Average age: {age_stats['mean']:.1f}\n")
-            f.write(f"- Minimum age: {age_stats['min']}\n")
-            f.write(f"- Maximum age: {age_stats['max']}\n\n")
+            f.write('\n'.join(lines))
+
+        # Machine-readable copy of the same statistics
+        json_stats_file = 'output/validation_stats.json'
+        with open(json_stats_file, 'w', encoding='utf-8') as f:
+            json.dump(validation_stats, f, ensure_ascii=False, indent=2, default=float)
         
         logging.info(f"Successfully transformed data and saved to {output_file}")
         logging.info(f"Validation statistics saved to {stats_file}")